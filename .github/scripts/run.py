@@ -1,14 +1,25 @@
 import os
+import random
 import json
 import hashlib
+import mmap
 import subprocess
+import time
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
+from typing import Iterator
 from datetime import datetime, timezone, timedelta, time as dtime
 
-from playwright.sync_api import sync_playwright
-from pdf2image import convert_from_path
+import fitz
+import numpy as np
+from playwright.sync_api import sync_playwright, TimeoutError as PlaywrightTimeoutError
 from PIL import Image
 
+try:
+    import orjson
+except ImportError:  # 沒裝 orjson 就用標準庫 json
+    orjson = None
+
 URL = "https://www.tapmc.com.tw/Pages/Trans/Price2"
 
 OUT = Path("docs")
@@ -21,8 +32,53 @@ STATE_PATH = OUT / "state.json"
 MANIFEST_PATH = OUT / "veg_manifest.json"
 VEG_PDF = OUT / "veg.pdf"
 
-# 圖片清晰度
-DPI = 220
+# 圖片清晰度：報表是向量 PDF，螢幕上看 150 DPI 已足夠；像素數約為 220 DPI 的 46%
+DPI = 150
+
+# PNG 壓縮等級：1 比預設的 6 快數倍，檔案只大一些
+PNG_COMPRESS_LEVEL = 1
+
+# 空白模板檢查用的縮圖：約 15 DPI（原本 120 DPI 再縮小 8 倍），每邊至少 200 px
+TEMPLATE_DPI = 15
+TEMPLATE_MIN_SIDE = 200
+# 灰階值低於此視為深色像素；深色比例低於 TEMPLATE_DARK_RATIO 視為空白模板
+TEMPLATE_DARK_LEVEL = 230
+TEMPLATE_DARK_RATIO = 0.012
+
+# CI 上 headless Chromium 的啟動參數：不用 /dev/shm、不啟用 GPU 與擴充功能，減少啟動時間與記憶體
+CHROMIUM_ARGS = [
+    "--disable-blink-features=AutomationControlled",
+    "--no-sandbox",
+    "--disable-dev-shm-usage",
+    "--disable-gpu",
+    "--disable-extensions",
+    "--disable-features=TranslateUI",
+]
+
+# 下載檔大於此大小才用 mmap，小檔建立映射的成本反而比直接讀還高
+MMAP_MIN_SIZE = 1024 * 1024
+
+# Playwright 的 Chromium 設定檔（HTTP 快取、cookies 等），跨次執行沿用
+PW_DIR = Path(".playwright")
+PW_PROFILE_DIR = PW_DIR / "profile"
+
+# 頁面元素的 CSS selector，在瀏覽器端一次解析；找不到時才退回逐一比對文字
+VEG_SELECT_SEL = "select:has(option:has-text('蔬菜'))"
+QUERY_BTN_SEL = "button:has-text('查詢'), input[type=button][value='查詢'], input[type=submit][value='查詢']"
+PDF_BTN_SEL = "a:has-text('下載PDF檔'), button:has-text('下載PDF檔')"
+
+# 點查詢後要等到的回應類型（只算 TAPMC 網站本身的請求）
+QUERY_RESPONSE_TYPES = {"xhr", "fetch", "document"}
+QUERY_RESPONSE_HOST = "tapmc.com.tw"
+
+# 只需要點按鈕下載 PDF，這些資源一律不載入
+BLOCKED_RESOURCE_TYPES = {"image", "media", "font", "stylesheet"}
+
+# 下載重試次數與間隔：1、2、4、8… 秒，上限 RETRY_MAX_DELAY，另加最多 RETRY_JITTER 秒隨機延遲
+MAX_ATTEMPTS = 5
+RETRY_BASE_DELAY = 1
+RETRY_MAX_DELAY = 16
+RETRY_JITTER = 1.0
 
 # 台北時區
 TPE_TZ = timezone(timedelta(hours=8))
@@ -31,23 +87,24 @@ TPE_TZ = timezone(timedelta(hours=8))
 WINDOW_START = dtime(7, 20)
 WINDOW_END = dtime(8, 4)
 
-def sha256_file(p: Path) -> str:
-    h = hashlib.sha256()
-    with p.open("rb") as f:
-        for chunk in iter(lambda: f.read(1024 * 1024), b""):
-            h.update(chunk)
-    return h.hexdigest()
-
 def load_json(p: Path):
     if p.exists():
         try:
+            if orjson is not None:
+                return orjson.loads(p.read_bytes())
             return json.loads(p.read_text(encoding="utf-8"))
         except Exception:
             return {}
     return {}
 
 def save_json(p: Path, obj: dict):
-    p.write_text(json.dumps(obj, ensure_ascii=False, indent=2), encoding="utf-8")
+    """先寫暫存檔再改名取代，執行被中斷也不會留下寫一半的 JSON"""
+    tmp = p.with_suffix(p.suffix + ".tmp")
+    if orjson is not None:
+        tmp.write_bytes(orjson.dumps(obj, option=orjson.OPT_INDENT_2))
+    else:
+        tmp.write_text(json.dumps(obj, ensure_ascii=False, indent=2), encoding="utf-8")
+    tmp.replace(p)
 
 def now_tpe_dt() -> datetime:
     return datetime.now(TPE_TZ)
@@ -59,6 +116,31 @@ def in_window(dt: datetime) -> bool:
     t = dt.time()
     return (t >= WINDOW_START) and (t <= WINDOW_END)
 
+def click_visible(page, selector: str) -> bool:
+    """點擊符合 selector 且肉眼可見的第一個元素；沒有符合的元素就立即回傳 False，不等待"""
+    target = page.locator(selector).locator("visible=true").first
+    if target.count() == 0:
+        return False
+    target.click(timeout=5000)
+    return True
+
+def find_query_button(page):
+    """找出肉眼可見的查詢按鈕，先用 CSS selector，再退回文字比對；找不到回傳 None"""
+    candidates = (
+        page.locator(QUERY_BTN_SEL),
+        page.get_by_text("查詢", exact=True),
+        page.locator("text=查詢"),
+    )
+    for loc in candidates:
+        btn = loc.locator("visible=true").first
+        if btn.count():
+            return btn
+    return None
+
+def is_query_response(response) -> bool:
+    req = response.request
+    return req.resource_type in QUERY_RESPONSE_TYPES and QUERY_RESPONSE_HOST in req.url
+
 def click_visible_text(page, text_to_find: str) -> bool:
     """找出畫面上所有符合文字的元素，並點擊肉眼可見的那一個"""
     elements = page.get_by_text(text_to_find, exact=True)
@@ -73,198 +155,400 @@ def click_visible_text(page, text_to_find: str) -> bool:
             return True
     return False
 
-def try_download_veg_pdf(page) -> bool:
-    page.goto(URL, wait_until="networkidle")
-
-    # 1️⃣ 選擇「蔬菜」
+def retry_delay(attempt: int) -> float:
+    """第 attempt 次嘗試失敗後要等幾秒再重試；最後一次失敗後不必再等"""
+    if attempt >= MAX_ATTEMPTS:
+        return 0
+    return min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** (attempt - 1)) + random.uniform(0, RETRY_JITTER)
+
+def block_heavy_resources(route):
+    """攔截圖片、字型等與下載 PDF 無關的請求，document / script / xhr 照常放行"""
+    if route.request.resource_type in BLOCKED_RESOURCE_TYPES:
+        route.abort()
+    else:
+        route.continue_()
+
+def wait_visible_text(page, text_to_find: str, timeout: int) -> bool:
+    """等待畫面上出現肉眼可見的指定文字元素，逾時回傳 False 交給後續流程處理"""
     try:
-        selects = page.locator("select")
-        found = False
-        for i in range(selects.count()):
-            sel = selects.nth(i)
+        page.get_by_text(text_to_find, exact=True).locator("visible=true").first.wait_for(state="visible", timeout=timeout)
+        return True
+    except Exception:
+        return False
+
+def new_pdf_hasher():
+    """PDF 內容摘要只用來判斷有沒有變動，不需要密碼學強度，所以用比 SHA-256 快的 BLAKE2b"""
+    return hashlib.blake2b(digest_size=32)
+
+def save_download(download, dest: Path) -> str:
+    """把 Playwright 下載的暫存檔寫到 dest，同一趟讀取順便算出內容摘要，不必事後再讀一次"""
+    h = new_pdf_hasher()
+    with open(download.path(), "rb") as src, dest.open("wb") as dst:
+        size = os.fstat(src.fileno()).st_size
+        mm = None
+        if size >= MMAP_MIN_SIZE:
             try:
-                sel.select_option(label="蔬菜")
-                found = True
-                break
-            except Exception:
-                continue
+                # 大檔直接映射整個檔案，雜湊與寫檔都不經過 Python 端的緩衝區複製
+                mm = mmap.mmap(src.fileno(), 0, access=mmap.ACCESS_READ)
+            except OSError:
+                # 部分檔案系統不支援 mmap，退回一般讀取；寫檔錯誤則照常往外拋
+                mm = None
+        if mm is not None:
+            with mm:
+                h.update(mm)
+                dst.write(mm)
+            return h.hexdigest()
+
+        buf = bytearray(1024 * 1024)
+        view = memoryview(buf)
+        while n := src.readinto(buf):
+            h.update(view[:n])
+            dst.write(view[:n])
+    return h.hexdigest()
+
+def fetch_pdf_direct(request, url: str) -> str | None:
+    """用瀏覽器的 cookies 直接以 HTTP 取得 PDF 寫到 VEG_PDF，不經過頁面點擊
+
+    成功時回傳內容摘要；回應失敗或內容不是 PDF 時回傳 None，交給頁面流程處理。
+    """
+    resp = request.get(url, timeout=30000)
+    if not resp.ok:
+        print(f"⚠️ 直接下載 PDF 失敗: HTTP {resp.status}")
+        return None
+    body = resp.body()
+    if not body.startswith(b"%PDF"):
+        print("⚠️ 直接下載的內容不是 PDF")
+        return None
+    h = new_pdf_hasher()
+    h.update(body)
+    VEG_PDF.write_bytes(body)
+    return h.hexdigest()
 
-        if not found:
+def open_veg_query(page) -> bool:
+    """載入查詢頁並選好「蔬菜」；重試時頁面狀態會保留，不必每次重新載入"""
+    page.goto(URL, wait_until="domcontentloaded")
+
+    # 1️⃣ 選擇「蔬菜」
+    try:
+        # 直接在瀏覽器端找出含「蔬菜」選項的下拉選單，不必逐一 count()/nth() 來回試
+        veg_select = page.locator(VEG_SELECT_SEL).first
+        try:
+            veg_select.wait_for(state="attached", timeout=15000)
+        except Exception:
             print("⚠️ 找不到蔬菜選項")
             return False
-        page.wait_for_timeout(800)
+        veg_select.select_option(label="蔬菜")
+        wait_visible_text(page, "查詢", timeout=5000)
+        return True
     except Exception as e:
         print(f"選取蔬菜失敗: {e}")
         return False
 
+def download_veg_pdf(page) -> tuple[str, str | None] | None:
+    """在已選好蔬菜的頁面點查詢並下載 PDF 到 VEG_PDF
+
+    成功時回傳 (內容摘要, 可直接 GET 重取的下載網址)，失敗回傳 None。
+    下載若來自 POST（例如 ASP.NET postback），單純 GET 同一網址可能拿到別的類別或日期的 PDF，
+    這時網址回傳 None，之後的重試都走頁面流程。
+    """
     # 2️⃣ 點查詢並等待資料載入
     try:
-        if not click_visible_text(page, "查詢"):
-            btn = page.locator("text=查詢").first
-            if btn.is_visible():
+        btn = find_query_button(page)
+        if btn is None:
+            print("⚠️ 查詢按鈕不可見")
+            return None
+
+        # 重試時同一頁的下載按鈕還停留在畫面上，只等按鈕出現會在新資料回來前就下載；
+        # 所以一定要等到這次查詢的回應
+        clicked = False
+        try:
+            with page.expect_response(is_query_response, timeout=15000):
                 btn.click(timeout=5000)
-            else:
-                print("⚠️ 查詢按鈕不可見")
-                return False
-
-        page.wait_for_load_state("networkidle")
-        page.wait_for_timeout(1500)
+                clicked = True
+        except PlaywrightTimeoutError:
+            if not clicked:
+                raise
+            # 查詢沒有發出可辨識的請求時，退回等待網路閒置
+            page.wait_for_load_state("networkidle", timeout=15000)
+
+        wait_visible_text(page, "下載PDF檔", timeout=15000)
     except Exception as e:
         print(f"點擊查詢失敗: {e}")
-        return False
+        return None
 
     # 3️⃣ 等待下載 PDF
+    # 記下點擊期間送出的請求，用來確認下載請求的 method 與表單內容
+    sent = []
+    on_request = sent.append
+    page.context.on("request", on_request)
     try:
         with page.expect_download(timeout=30000) as d:
-            if not click_visible_text(page, "下載PDF檔"):
+            if not click_visible(page, PDF_BTN_SEL) and not click_visible_text(page, "下載PDF檔"):
                 btn = page.get_by_text("PDF").first
                 if btn.is_visible():
                     btn.click(timeout=5000)
                 else:
                     print("⚠️ PDF 下載按鈕不可見")
-                    return False
+                    return None
 
-        d.value.save_as(str(VEG_PDF))
-        return True
+        url = d.value.url
+        req = next((r for r in reversed(sent) if r.url == url), None)
+        if req is None or req.method != "GET" or req.post_data is not None:
+            url = None
+        return save_download(d.value, VEG_PDF), url
     except Exception as e:
         print(f"下載失敗: {e}")
-        return False
+        return None
+    finally:
+        page.context.remove_listener("request", on_request)
 
-def pdf_looks_like_template(pdf_path: Path) -> tuple[bool, dict]:
+def pdf_looks_like_template(doc: fitz.Document) -> tuple[bool, dict]:
     """檢查 PDF 深色比例，過低代表空白模板"""
     info = {}
     try:
-        imgs = convert_from_path(str(pdf_path), dpi=120, first_page=1, last_page=1)
-        if not imgs:
+        if doc.page_count == 0:
             return True, {"reason": "no_page_rendered"}
+        # 直接以縮圖尺寸轉出第 1 頁，不先轉高解析度再縮小
+        page = doc[0]
+        rect = page.rect
+        sw = max(TEMPLATE_MIN_SIDE, int(rect.width * TEMPLATE_DPI / 72))
+        sh = max(TEMPLATE_MIN_SIDE, int(rect.height * TEMPLATE_DPI / 72))
+        pix = page.get_pixmap(
+            matrix=fitz.Matrix(sw / rect.width, sh / rect.height),
+            alpha=False,
+            colorspace=fitz.csGRAY,
+        )
 
-        img = imgs[0].convert("L")
-        w, h = img.size
-        img_small = img.resize((max(200, w // 8), max(200, h // 8)))
-        px = list(img_small.getdata())
+        arr = np.frombuffer(pix.samples, dtype=np.uint8).reshape(pix.height, pix.width)
 
-        dark = sum(1 for v in px if v < 230)
-        total = len(px)
+        total = arr.size
+        dark = int(np.count_nonzero(arr < TEMPLATE_DARK_LEVEL))
         ratio = dark / total if total else 0
 
-        info = {"dark_ratio": round(ratio, 6), "sample_size": [img_small.size[0], img_small.size[1]]}
-        is_template = ratio < 0.012
+        info = {"dark_ratio": round(ratio, 6), "sample_size": [pix.width, pix.height]}
+        is_template = ratio < TEMPLATE_DARK_RATIO
         return is_template, info
     except Exception as e:
         return False, {"reason": "template_check_error", "error": str(e)}
 
-def pdf_contains_today(pdf_path: Path, date_str: str) -> bool:
+def pdf_contains_today(doc: fitz.Document, date_str: str) -> bool:
     """檢查 PDF 文字內容是否包含今天日期，防止休市空白 PDF 被誤判為有效資料"""
     try:
-        result = subprocess.run(
-            ["pdftotext", str(pdf_path), "-"],
-            capture_output=True, text=True, timeout=15
-        )
-        contains = date_str in result.stdout
-        if not contains:
-            print(f"⚠️ PDF 內容不含今天日期 {date_str}，可能是休市或舊資料。")
-        return contains
+        # 直接用已開啟的文件逐頁抽文字，找到日期就停，不必另外啟動 pdftotext
+        contains = any(date_str in page.get_text("text") for page in doc)
     except Exception as e:
-        print(f"⚠️ pdftotext 執行失敗: {e}，跳過日期驗證。")
-        # 若 pdftotext 失敗就不擋，避免誤殺正常資料
-        return True
+        print(f"⚠️ PyMuPDF 抽取文字失敗: {e}，改用 pdftotext。")
+        try:
+            result = subprocess.run(
+                ["pdftotext", doc.name, "-"],
+                stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, timeout=15
+            )
+            # pdftotext 預設輸出 UTF-8，直接比對位元組，不必把整份輸出解碼成字串
+            contains = date_str.encode("utf-8") in result.stdout
+        except Exception as e:
+            print(f"⚠️ pdftotext 執行失敗: {e}，跳過日期驗證。")
+            # 若 pdftotext 也失敗就不擋，避免誤殺正常資料
+            return True
 
-def render_all_pages(pdf_path: Path) -> list[Path]:
-    images = convert_from_path(str(pdf_path), dpi=DPI)
-    out_files: list[Path] = []
-    for i, img in enumerate(images, start=1):
-        filename = f"veg_p{i:02d}.png"
-        out_png = PAGES_DIR / filename
-        tmp = out_png.with_suffix(".tmp.png")
-        img.save(str(tmp), "PNG")
-        tmp.replace(out_png)
-        out_files.append(out_png)
-    return out_files
-
-def clean_extra_pages(keep: set[str]):
-    for p in PAGES_DIR.glob("veg_p*.png"):
-        if p.name not in keep:
-            try:
-                p.unlink()
-            except Exception:
-                pass
+    if not contains:
+        print(f"⚠️ PDF 內容不含今天日期 {date_str}，可能是休市或舊資料。")
+    return contains
+
+def page_png_path(page_no: int) -> Path:
+    return PAGES_DIR / f"veg_p{page_no:02d}.png"
+
+def write_page_png(page, out_png: Path, prev_digest: str | None = None) -> str:
+    """把單一頁面轉成 PNG，寫完立即釋放 pixmap，回傳該頁像素的摘要
+
+    像素摘要與上次相同且 PNG 還在時（例如 PDF 只有中繼資料變動）就不重新壓縮寫檔。
+    """
+    mat = fitz.Matrix(DPI / 72, DPI / 72)
+    # 行情表是單色表格，用灰階轉檔，每個像素 1 byte 而不是 RGB 的 3 bytes
+    pix = page.get_pixmap(matrix=mat, alpha=False, colorspace=fitz.csGRAY)
+    digest = hashlib.blake2b(pix.samples_mv, digest_size=16).hexdigest()
+    if digest == prev_digest and out_png.exists():
+        return digest
+    # frombuffer 直接引用 pixmap 的記憶體，不再複製一份像素給 PIL；
+    # 仍經過 PIL 編碼是因為 pix.save() 無法調整 PNG 壓縮等級
+    img = Image.frombuffer("L", (pix.width, pix.height), pix.samples_mv, "raw", "L", pix.stride, 1)
+    # 工作流程只有單一寫入者、結束後才 commit，直接寫到最終檔名，省去暫存檔改名
+    img.save(str(out_png), "PNG", compress_level=PNG_COMPRESS_LEVEL, optimize=False)
+    del img, pix
+    return digest
+
+def _render_page_job(job: tuple[str, int, str | None]) -> tuple[Path, str]:
+    """子行程各自開啟 PDF 轉一頁（MuPDF 文件物件不能跨行程共用）"""
+    pdf_path, page_no, prev_digest = job
+    out_png = page_png_path(page_no)
+    with fitz.open(pdf_path) as doc:
+        digest = write_page_png(doc[page_no - 1], out_png, prev_digest)
+    return out_png, digest
+
+def iter_render_pages(doc: fitz.Document, prev_digests: dict[str, str]) -> Iterator[tuple[Path, str]]:
+    """逐頁轉成 PNG，每處理完一頁就交出 (路徑, 像素摘要)；任何時刻每個行程只有一頁的影像在記憶體中
+
+    prev_digests 是上一份 manifest 記錄的各頁像素摘要，相同的頁面不重新寫檔。
+    單頁時直接用已開啟的 doc（與空白模板檢查共用，不重新解析 PDF）；
+    多頁 PDF 交給 ProcessPoolExecutor 平行轉檔與壓縮 PNG，子行程依 doc.name 各自開檔。
+    """
+    page_count = doc.page_count
+    workers = min(os.cpu_count() or 1, page_count)
+    if workers < 2:
+        for i, page in enumerate(doc, start=1):
+            out_png = page_png_path(i)
+            digest = write_page_png(page, out_png, prev_digests.get(out_png.name))
+            yield out_png, digest
+        return
 
-def main():
+    jobs = [(doc.name, i, prev_digests.get(page_png_path(i).name)) for i in range(1, page_count + 1)]
+    with ProcessPoolExecutor(max_workers=workers) as ex:
+        yield from ex.map(_render_page_job, jobs)
+
+def clean_extra_pages(prev_pages: list[str], keep: set[str]):
+    """刪除上一份 manifest 列出、這次已不再產生的頁面圖檔，不必掃描整個目錄"""
+    for name in set(prev_pages) - keep:
+        (PAGES_DIR / name).unlink(missing_ok=True)
+
+def run(state: dict):
+    """執行一次抓取流程；所有狀態變更都直接寫進 state，由 main 統一存檔"""
     now_dt = now_tpe_dt()
     now_str = now_tpe_str()
     today_str = now_dt.strftime("%Y-%m-%d")
 
-    state = load_json(STATE_PATH)
-
     is_manual_trigger = os.environ.get("GITHUB_EVENT_NAME") == "workflow_dispatch"
 
     if not is_manual_trigger and not in_window(now_dt):
         print("⏳ 目前不在允許的時間窗內，跳過執行。")
         state.update({"time_taipei": now_str, "status": "skip_outside_window", "date": today_str, "detail": "skip_run_outside_0720_0804"})
-        save_json(STATE_PATH, state)
         return
 
     print("🚀 開始執行抓取流程...")
     is_success = False
     last_detail = ""
     last_dark_ratio = None
+    prev_hash = state.get("veg_pdf_digest", "")
+    veg_hash = None
+    unchanged = False
+    # 每次下載後開啟一次，空白模板檢查與最後轉檔共用同一份
+    veg_doc = None
 
     with sync_playwright() as p:
-        browser = p.chromium.launch(headless=True)
+        context = p.chromium.launch_persistent_context(
+            str(PW_PROFILE_DIR),
+            headless=True,
+            args=CHROMIUM_ARGS,
+            locale="zh-TW",
+            timezone_id="Asia/Taipei",
+            viewport={'width': 1280, 'height': 800},
+        )
         try:
-            context = browser.new_context(
-                locale="zh-TW",
-                timezone_id="Asia/Taipei",
-                viewport={'width': 1280, 'height': 800}
-            )
-
-            for attempt in range(1, 6):
+            context.route("**/*", block_heavy_resources)
+
+            page = context.pages[0] if context.pages else context.new_page()
+            page_ready = False
+            # 頁面下載的請求是單純 GET 時記下網址，之後的重試直接用 HTTP 取得
+            pdf_url = None
+            # 最近一次由頁面流程下載到的 PDF 摘要
+            page_hash = None
+            # 本次執行中已被退回的 PDF：摘要 -> (原因, 深色比例)；同樣內容再下載到時不必重新轉圖、抽文字
+            rejected: dict[str, tuple[str, float | None]] = {}
+            for attempt in range(1, MAX_ATTEMPTS + 1):
                 print(f"--- 嘗試第 {attempt} 次下載 ---")
 
-                page = context.new_page()
+                # 下一次下載會覆寫 VEG_PDF，先關掉上一次開啟的文件
+                if veg_doc is not None:
+                    veg_doc.close()
+                    veg_doc = None
+
+                veg_hash = None
                 try:
-                    ok = try_download_veg_pdf(page)
+                    if pdf_url:
+                        try:
+                            veg_hash = fetch_pdf_direct(context.request, pdf_url)
+                        except Exception as e:
+                            # 逾時或連線錯誤不算這次失敗，直接改走頁面流程
+                            print(f"⚠️ 直接下載 PDF 失敗: {e}")
+                            veg_hash = None
+                        if veg_hash is None:
+                            # 這個網址無法直接取得 PDF，之後都走頁面流程
+                            pdf_url = None
+                        elif veg_hash in rejected or veg_hash == page_hash:
+                            # 網址拿到的還是同一份內容，下一次改回頁面重新查詢才可能取得新資料
+                            pdf_url = None
+
+                    if veg_hash is None:
+                        # 只有第一次或上次下載失敗時才重新載入頁面，其餘重試直接再點查詢
+                        if not page_ready:
+                            page_ready = open_veg_query(page)
+                        result = download_veg_pdf(page) if page_ready else None
+                        if result is not None:
+                            veg_hash, url = result
+                            page_hash = veg_hash
+                            pdf_url = url if url and url.startswith(("http://", "https://")) else None
+
+                    if veg_hash is not None:
+                        veg_doc = fitz.open(str(VEG_PDF))
                 except Exception as e:
                     print(f"⚠️ 第 {attempt} 次發生未預期錯誤: {e}")
-                    ok = False
-                finally:
-                    page.close()
+                    veg_hash = None
+                    pdf_url = None
 
-                if not ok or not VEG_PDF.exists():
+                if veg_hash is None or veg_doc is None:
+                    page_ready = False
                     last_detail = f"attempt_{attempt}_download_failed"
-                    print(f"⚠️ 下載失敗或檔案不存在，等待 2 秒後重試...")
-                    import time
-                    time.sleep(2)
+                    delay = retry_delay(attempt)
+                    print(f"⚠️ 下載失敗或檔案不存在，等待 {delay:.1f} 秒後重試...")
+                    time.sleep(delay)
                     continue
 
-                is_tmpl, info = pdf_looks_like_template(VEG_PDF)
-                last_dark_ratio = info.get("dark_ratio")
+                unchanged = veg_hash == prev_hash
+
+                if veg_hash in rejected:
+                    reason, last_dark_ratio = rejected[veg_hash]
+                    last_detail = f"attempt_{attempt}_{reason}"
+                    delay = retry_delay(attempt)
+                    print(f"⚠️ 與先前退回的 PDF 內容相同 ({reason})，等待 {delay:.1f} 秒後重試...")
+                    time.sleep(delay)
+                    continue
+
+                if unchanged:
+                    # 與上次成功處理的 PDF 位元組相同，已知不是空白模板，不必再轉圖檢查；
+                    # 深色比例沿用上次記錄的值
+                    is_tmpl = False
+                    last_dark_ratio = state.get("last_dark_ratio")
+                else:
+                    is_tmpl, info = pdf_looks_like_template(veg_doc)
+                    last_dark_ratio = info.get("dark_ratio")
 
                 if is_tmpl:
+                    rejected[veg_hash] = ("pdf_template_no_data", last_dark_ratio)
                     last_detail = f"attempt_{attempt}_pdf_template_no_data"
-                    print(f"⚠️ 抓到空白模板 (深色比例 {last_dark_ratio})，等待 3 秒後重試...")
-                    import time
-                    time.sleep(3)
+                    delay = retry_delay(attempt)
+                    print(f"⚠️ 抓到空白模板 (深色比例 {last_dark_ratio})，等待 {delay:.1f} 秒後重試...")
+                    time.sleep(delay)
                     continue
 
                 # 🆕 新增：檢查 PDF 是否包含今天日期，防止休市 PDF 被誤判
-                if not pdf_contains_today(VEG_PDF, today_str):
+                if not pdf_contains_today(veg_doc, today_str):
+                    rejected[veg_hash] = ("pdf_not_today", last_dark_ratio)
                     last_detail = f"attempt_{attempt}_pdf_not_today"
-                    print(f"⚠️ PDF 不含今天日期，等待 3 秒後重試...")
-                    import time
-                    time.sleep(3)
+                    delay = retry_delay(attempt)
+                    print(f"⚠️ PDF 不含今天日期，等待 {delay:.1f} 秒後重試...")
+                    time.sleep(delay)
                     continue
 
                 print(f"✅ 成功取得有效 PDF！(深色比例 {last_dark_ratio})")
                 is_success = True
                 break
 
-            context.close()
         finally:
-            browser.close()
+            # 關閉時會把快取與 cookies 寫回設定檔目錄
+            context.close()
 
     if not is_success:
-        print(f"❌ 5 次嘗試都失敗，最後狀態: {last_detail}")
+        if veg_doc is not None:
+            veg_doc.close()
+        print(f"❌ {MAX_ATTEMPTS} 次嘗試都失敗，最後狀態: {last_detail}")
         state.update({
             "time_taipei": now_str,
             "status": "not_ready_or_template" if "template" in last_detail else ("holiday_or_old_data" if "not_today" in last_detail else "veg_download_failed"),
@@ -272,35 +556,39 @@ def main():
             "detail": last_detail,
             "last_dark_ratio": last_dark_ratio,
         })
-        save_json(STATE_PATH, state)
         return
 
-    veg_hash = sha256_file(VEG_PDF)
-    prev_hash = state.get("veg_pdf_sha256", "")
-
-    if veg_hash == prev_hash and MANIFEST_PATH.exists():
+    if unchanged and MANIFEST_PATH.exists():
         print("ℹ️ PDF 內容無變動，跳過轉檔與更新。")
+        veg_doc.close()
         state.update({
             "time_taipei": now_str,
             "status": "no_change",
             "date": today_str,
-            "veg_pdf_sha256": veg_hash,
+            "veg_pdf_digest": veg_hash,
             "last_dark_ratio": last_dark_ratio,
         })
-        save_json(STATE_PATH, state)
         return
 
     print("🖼️ 開始將 PDF 轉成 PNG...")
-    pages = render_all_pages(VEG_PDF)
+    prev_manifest = load_json(MANIFEST_PATH)
+    prev_digests = prev_manifest.get("page_digests", {})
+    try:
+        rendered = list(iter_render_pages(veg_doc, prev_digests))
+    finally:
+        veg_doc.close()
+    pages = [p for p, _ in rendered]
+    page_digests = {p.name: digest for p, digest in rendered}
     keep_names = {p.name for p in pages}
-    clean_extra_pages(keep_names)
+    clean_extra_pages(prev_manifest.get("pages", []), keep_names)
 
     manifest = {
         "generated_at_taipei": now_str,
         "date": today_str,
-        "veg_pdf_sha256": veg_hash,
+        "veg_pdf_digest": veg_hash,
         "dpi": DPI,
         "pages": [p.name for p in pages],
+        "page_digests": page_digests,
     }
     save_json(MANIFEST_PATH, manifest)
 
@@ -308,12 +596,21 @@ def main():
         "time_taipei": now_str,
         "status": "updated",
         "date": today_str,
-        "veg_pdf_sha256": veg_hash,
+        "veg_pdf_digest": veg_hash,
         "page_count": len(pages),
         "last_dark_ratio": last_dark_ratio,
     })
-    save_json(STATE_PATH, state)
     print("🎉 所有流程更新完成！")
 
+def main():
+    state = load_json(STATE_PATH)
+    # 舊版記錄的是 SHA-256，與現在的 BLAKE2b 摘要無法比較
+    state.pop("veg_pdf_sha256", None)
+    try:
+        run(state)
+    finally:
+        # 不論從哪個分支結束（包含例外），state 只序列化、寫檔一次
+        save_json(STATE_PATH, state)
+
 if __name__ == "__main__":
     main()